@@ -1,18 +1,31 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import Iterator, List, Optional, Tuple
 import chromadb
 import os
 import logging
 from enum import Enum
 import hashlib
-import requests
+import sqlite3
+import threading
+import numpy as np
+import httpx
+import asyncio
+from functools import partial
 import json
+import orjson
+
+try:
+    from openai import AsyncOpenAI
+except ImportError:
+    AsyncOpenAI = None
 
 app = FastAPI(
     title="Ingestion Service",
     description="Document ingestion service for RAG chatbot",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 logger = logging.getLogger(__name__)
 
@@ -28,8 +41,14 @@ class DocumentInput(BaseModel):
 class IngestionRequest(BaseModel):
     botId: str
     documents: List[DocumentInput]
-    chunkSize: Optional[int] = 600
-    overlap: Optional[int] = 80
+    chunkSize: int = Field(600, gt=0)
+    overlap: int = Field(80, ge=0)
+    
+    @model_validator(mode="after")
+    def check_overlap(self) -> "IngestionRequest":
+        if self.overlap >= self.chunkSize:
+            raise ValueError("overlap must be smaller than chunkSize")
+        return self
 
 class IngestionResponse(BaseModel):
     botId: str
@@ -40,90 +59,323 @@ MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "ollama")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_data")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "5"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "512"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", str(EMBED_BATCH_SIZE)))
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "2"))
 
 os.makedirs(CHROMA_PERSIST_DIR, exist_ok=True)
 
 chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
 
+# Created on startup so it binds to the server's event loop
+async_http_client: Optional[httpx.AsyncClient] = None
+
+async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if AsyncOpenAI and OPENAI_API_KEY else None
+
+EMBEDDING_PROVIDER = MODEL_PROVIDER
+if MODEL_PROVIDER == ModelProvider.OPENAI and async_openai_client is None:
+    logger.warning("OPENAI_API_KEY not set or openai not installed, using Ollama embeddings")
+    EMBEDDING_PROVIDER = ModelProvider.OLLAMA.value
+
+def open_embedding_cache(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS embedding_cache ("
+        "hash TEXT, provider TEXT, model TEXT, vec BLOB, PRIMARY KEY (hash, provider, model))"
+    )
+    connection.commit()
+    return connection
+
+# Accessed from executor threads; the lock serializes use of the shared connection
+embedding_cache_lock = threading.Lock()
+embedding_cache = open_embedding_cache(os.path.join(CHROMA_PERSIST_DIR, "embedding_cache.sqlite3"))
+
+EMBEDDING_MODELS = {
+    ModelProvider.OPENAI: "text-embedding-3-small",
+    ModelProvider.OLLAMA: "nomic-embed-text",
+}
+
 def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
-    """Split text into overlapping chunks."""
-    chunks = []
-    start = 0
-    
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-        
-        if end >= len(text):
-            break
+    """Split text into overlapping chunks; expects 0 <= overlap < chunk_size."""
+    if not text:
+        return []
     
-    return chunks
+    # The last chunk starts before len(text) - overlap; later starts would lie entirely in its overlap
+    starts = range(0, max(len(text) - overlap, 1), chunk_size - overlap)
+    return [text[start:start + chunk_size] for start in starts]
 
-def get_ollama_embeddings(texts: List[str], model: str = "nomic-embed-text") -> List[List[float]]:
-    """Get embeddings using Ollama local models."""
-    embeddings = []
+async def aget_ollama_embeddings(texts: List[str], model: str = "nomic-embed-text") -> List[Optional[List[float]]]:
+    """Get embeddings using Ollama local models, sending batches concurrently.
     
-    for text in texts:
-        try:
-            response = requests.post(
-                f"{OLLAMA_BASE_URL}/api/embeddings",
-                json={
-                    "model": model,
-                    "prompt": text
-                },
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                embedding_data = response.json()
-                embeddings.append(embedding_data["embedding"])
-                logger.debug(f"Successfully generated embedding for text of length {len(text)}")
-            else:
+    Texts in batches that Ollama failed to embed come back as None.
+    """
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    
+    async def embed_batch(batch: List[str]) -> List[Optional[List[float]]]:
+        async with semaphore:
+            try:
+                response = await async_http_client.post(
+                    "/api/embed",
+                    json={
+                        "model": model,
+                        "input": batch
+                    }
+                )
+                
+                if response.status_code == 200:
+                    batch_embeddings = orjson.loads(response.content)["embeddings"]
+                    if len(batch_embeddings) != len(batch):
+                        raise ValueError(f"expected {len(batch)} embeddings, got {len(batch_embeddings)}")
+                    logger.debug("Successfully generated %d embeddings", len(batch))
+                    return batch_embeddings
+                
                 logger.warning(f"Ollama embedding failed with status {response.status_code}: {response.text}")
-                embeddings.append(create_simple_embedding(text))
                 
-        except Exception as e:
-            logger.error(f"Ollama embedding error: {e}")
-            embeddings.append(create_simple_embedding(text))
+            except Exception as e:
+                logger.error(f"Ollama embedding error: {e}")
+        
+        return [None] * len(batch)
     
-    return embeddings
+    batches = [texts[start:start + EMBED_BATCH_SIZE] for start in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [embedding for batch_embeddings in results for embedding in batch_embeddings]
 
 def create_simple_embedding(text: str) -> List[float]:
     """Create a simple embedding as fallback."""
-    embedding = [0.0] * 384
-    for i, char in enumerate(text[:384]):
-        embedding[i] = (ord(char) % 100) / 100.0
+    codes = np.frombuffer(text[:384].encode("utf-32-le"), dtype=np.uint32)
+    embedding = np.zeros(384)
+    embedding[:len(codes)] = (codes % 100) / 100.0
     embedding[0] = min(len(text) / 1000.0, 1.0)
-    return embedding
+    return embedding.tolist()
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Get embeddings based on configured model provider."""
+async def aget_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """Get embeddings based on configured model provider without blocking the event loop.
+    
+    Texts the provider failed to embed come back as None.
+    """
     try:
-        if MODEL_PROVIDER == ModelProvider.OPENAI:
-            import openai
-            if not OPENAI_API_KEY:
-                logger.warning("OPENAI_API_KEY not set, using Ollama embeddings")
-                return get_ollama_embeddings(texts)
+        if EMBEDDING_PROVIDER == ModelProvider.OPENAI:
+            semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
             
-            response = openai.embeddings.create(
-                model="text-embedding-3-small",
-                input=texts
-            )
-            return [data.embedding for data in response.data]
+            async def embed_batch(batch: List[str]) -> List[List[float]]:
+                async with semaphore:
+                    response = await async_openai_client.embeddings.create(
+                        model="text-embedding-3-small",
+                        input=batch
+                    )
+                return [data.embedding for data in response.data]
+            
+            batches = [texts[start:start + EMBED_BATCH_SIZE] for start in range(0, len(texts), EMBED_BATCH_SIZE)]
+            results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+            return [embedding for batch_embeddings in results for embedding in batch_embeddings]
         
-        elif MODEL_PROVIDER == ModelProvider.OLLAMA:
-            logger.info(f"Using Ollama for embeddings with {len(texts)} texts")
-            return get_ollama_embeddings(texts)
+        elif EMBEDDING_PROVIDER == ModelProvider.OLLAMA:
+            logger.debug("Using Ollama for embeddings with %d texts", len(texts))
+            return await aget_ollama_embeddings(texts)
         
         else: 
-            logger.info("Using simple mock embeddings")
+            logger.debug("Using simple mock embeddings")
             return [create_simple_embedding(text) for text in texts]
     
     except Exception as e:
         logger.error(f"Embedding generation failed: {str(e)}")
-        logger.info("Falling back to simple embeddings")
-        return [create_simple_embedding(text) for text in texts]
+        return [None] * len(texts)
+
+class EmbeddingBatcher:
+    """Coalesce embedding requests from concurrent ingestions into shared provider calls."""
+    
+    def __init__(self, max_batch_size: int, wait_timeout_s: float, max_in_flight: int):
+        self.max_batch_size = max_batch_size
+        self.wait_timeout_s = wait_timeout_s
+        self.max_in_flight = max_in_flight
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.batch_tasks = set()
+        # Items the worker has dequeued but not yet handed to a batch task
+        self.collecting = []
+    
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.worker = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        self.worker = None
+        
+        # Nothing will dispatch these any more; fail them so callers don't wait forever
+        error = RuntimeError("embedding batcher stopped")
+        self._fail(self.collecting, error)
+        self.collecting = []
+        while not self.queue.empty():
+            self._fail([self.queue.get_nowait()], error)
+        
+        await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+    
+    async def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        if self.worker is None:
+            raise RuntimeError("embedding batcher is not running")
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        for text, future in zip(texts, futures):
+            self.queue.put_nowait((text, future))
+        return list(await asyncio.gather(*futures))
+    
+    async def _run(self):
+        while True:
+            self.collecting = items = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                # Give other in-flight requests a moment to contribute to this batch
+                await asyncio.sleep(self.wait_timeout_s)
+            while len(items) < self.max_batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self._embed_batch(items))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+            self.collecting = []
+    
+    async def _embed_batch(self, items):
+        try:
+            embeddings = await aget_embeddings([text for text, _ in items])
+            if len(embeddings) != len(items):
+                raise ValueError(f"expected {len(items)} embeddings, got {len(embeddings)}")
+            for (_, future), embedding in zip(items, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            self._fail(items, e)
+        finally:
+            # Covers cancellation of this task, so no caller is left waiting
+            self._fail(items, RuntimeError("embedding batch did not complete"))
+            self.in_flight.release()
+    
+    @staticmethod
+    def _fail(items, error: Exception):
+        for _, future in items:
+            if not future.done():
+                future.set_exception(error)
+
+embedding_batcher = EmbeddingBatcher(MAX_BATCH_SIZE, BATCH_WAIT_MS / 1000.0, EMBED_CONCURRENCY)
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def load_cached_embeddings(hashes: List[str], model: str) -> dict:
+    """Look up cached embeddings for the given content hashes; blocking, run it in an executor."""
+    cached = {}
+    unique_hashes = list(set(hashes))
+    with embedding_cache_lock:
+        # Stay under SQLite's default bound-parameter limit
+        for start in range(0, len(unique_hashes), 900):
+            batch = unique_hashes[start:start + 900]
+            rows = embedding_cache.execute(
+                f"SELECT hash, vec FROM embedding_cache WHERE provider = ? AND model = ? "
+                f"AND hash IN ({','.join('?' * len(batch))})",
+                [EMBEDDING_PROVIDER, model, *batch]
+            )
+            for h, vec in rows:
+                cached[h] = np.frombuffer(vec, dtype=np.float16).astype(np.float32).tolist()
+    return cached
+
+def store_cached_embeddings(rows: List[Tuple[str, str, str, bytes]]):
+    """Write (hash, provider, model, vec) rows to the embedding cache; blocking, run it in an executor."""
+    with embedding_cache_lock:
+        embedding_cache.executemany(
+            "INSERT OR REPLACE INTO embedding_cache (hash, provider, model, vec) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        embedding_cache.commit()
+
+async def aget_cached_embeddings(texts: List[str]) -> List[List[float]]:
+    """Get embeddings, only calling the provider for texts not already in the embedding cache."""
+    model = EMBEDDING_MODELS.get(EMBEDDING_PROVIDER)
+    if model is None:
+        embeddings = await aget_embeddings(texts)
+        return [create_simple_embedding(text) if vec is None else vec for text, vec in zip(texts, embeddings)]
+    
+    loop = asyncio.get_running_loop()
+    hashes = [content_hash(text) for text in texts]
+    cached = await loop.run_in_executor(None, load_cached_embeddings, hashes, model)
+    
+    embeddings: List[Optional[List[float]]] = [cached.get(h) for h in hashes]
+    # Embed each distinct uncached chunk once, keyed by its first occurrence
+    first_uncached = {}
+    for i, h in enumerate(hashes):
+        if embeddings[i] is None:
+            first_uncached.setdefault(h, i)
+    uncached_indices = list(first_uncached.values())
+    logger.debug("Embedding %d distinct uncached chunks out of %d", len(uncached_indices), len(texts))
+    
+    if uncached_indices:
+        # Embed similar lengths together so provider batches carry less padding
+        uncached_indices.sort(key=lambda i: len(texts[i]))
+        uncached_texts = [texts[i] for i in uncached_indices]
+        fresh = await embedding_batcher.embed(uncached_texts)
+        provider_indices, provider_vecs = [], []
+        fallbacks = 0
+        for i, text, vec in zip(uncached_indices, uncached_texts, fresh):
+            # Fall back to simple embeddings for texts the provider failed on, without caching them
+            if vec is None:
+                embeddings[i] = create_simple_embedding(text)
+                fallbacks += 1
+            else:
+                provider_indices.append(i)
+                provider_vecs.append(vec)
+        if fallbacks:
+            logger.info("Falling back to simple embeddings for %d chunks", fallbacks)
+        
+        if provider_vecs:
+            vecs = np.asarray(provider_vecs, dtype=np.float32)
+            vecs /= np.linalg.norm(vecs, axis=1, keepdims=True).clip(min=1e-12)
+            # Store as float16 and hand back the same rounded values so hits and misses agree
+            vecs_f16 = vecs.astype(np.float16)
+            for i, vec in zip(provider_indices, vecs_f16.astype(np.float32).tolist()):
+                embeddings[i] = vec
+            rows = [(hashes[i], EMBEDDING_PROVIDER, model, vec.tobytes()) for i, vec in zip(provider_indices, vecs_f16)]
+            await loop.run_in_executor(None, store_cached_embeddings, rows)
+        
+        for i, h in enumerate(hashes):
+            if embeddings[i] is None:
+                embeddings[i] = embeddings[first_uncached[h]]
+    
+    return embeddings
+
+def iter_chunk_batches(request: IngestionRequest, batch_size: int) -> Iterator[Tuple[List[str], List[str], List[dict]]]:
+    """Chunk the request's documents, yielding (ids, chunks, metadatas) batches of at most batch_size."""
+    ids, chunks, metadatas = [], [], []
+    bot_suffix = f"_{request.botId}".encode()
+    
+    for doc_idx, document in enumerate(request.documents):
+        document_chunks = chunk_text(document.text, request.chunkSize, request.overlap)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Document '%s' split into %d chunks", document.filename, len(document_chunks))
+        filename_prefix = f"{document.filename}_".encode()
+        
+        for chunk_idx, chunk in enumerate(document_chunks):
+            chunks.append(chunk)
+            metadatas.append({
+                "filename": document.filename,
+                "bot_id": request.botId,
+                "chunk_index": chunk_idx,
+                "document_index": doc_idx,
+                "chunk_size": len(chunk)
+            })
+            # Same bytes as f"{filename}_{chunk_idx}_{botId}", so IDs match previously ingested chunks
+            ids.append(hashlib.md5(b"%b%d%b" % (filename_prefix, chunk_idx, bot_suffix), usedforsecurity=False).hexdigest())
+            
+            if len(chunks) == batch_size:
+                yield ids, chunks, metadatas
+                ids, chunks, metadatas = [], [], []
+    
+    if chunks:
+        yield ids, chunks, metadatas
 
 @app.post("/ingest", response_model=IngestionResponse)
 async def ingest_documents(request: IngestionRequest):
@@ -140,43 +392,43 @@ async def ingest_documents(request: IngestionRequest):
             )
             logger.info(f"Created new collection: {collection_name}")
         
-        all_chunks = []
-        all_metadatas = []
-        all_ids = []
+        logger.info(f"Generating embeddings and upserting chunks using {EMBEDDING_PROVIDER}...")
         
-        for doc_idx, document in enumerate(request.documents):
-            chunks = chunk_text(document.text, request.chunkSize, request.overlap)
-            logger.info(f"Document '{document.filename}' split into {len(chunks)} chunks")
-            
-            for chunk_idx, chunk in enumerate(chunks):
-                all_chunks.append(chunk)
-                all_metadatas.append({
-                    "filename": document.filename,
-                    "bot_id": request.botId,
-                    "chunk_index": chunk_idx,
-                    "document_index": doc_idx,
-                    "chunk_size": len(chunk)
-                })
-                chunk_id = hashlib.md5(f"{document.filename}_{chunk_idx}_{request.botId}".encode()).hexdigest()
-                all_ids.append(chunk_id)
+        loop = asyncio.get_running_loop()
+        pending_upsert = None
+        upserted = 0
         
-        logger.info(f"Generating embeddings for {len(all_chunks)} chunks using {MODEL_PROVIDER}...")
-        
-        embeddings = get_embeddings(all_chunks)
-        
-        logger.info(f"Upserting {len(all_chunks)} chunks to Chroma...")
-        collection.upsert(
-            embeddings=embeddings,
-            documents=all_chunks,
-            metadatas=all_metadatas,
-            ids=all_ids
-        )
+        try:
+            for ids, chunks, metadatas in iter_chunk_batches(request, UPSERT_BATCH_SIZE):
+                embeddings = await aget_cached_embeddings(chunks)
+                
+                # Let Chroma write the previous batch while this one was being embedded
+                if pending_upsert is not None:
+                    await pending_upsert
+                
+                logger.debug("Upserting %d chunks to Chroma...", len(chunks))
+                pending_upsert = loop.run_in_executor(None, partial(
+                    collection.upsert,
+                    embeddings=embeddings,
+                    documents=chunks,
+                    metadatas=metadatas,
+                    ids=ids
+                ))
+                upserted += len(chunks)
+            
+            if pending_upsert is not None:
+                await pending_upsert
+                pending_upsert = None
+        finally:
+            # On failure, don't return while a write is still running or leave its error unretrieved
+            if pending_upsert is not None:
+                await asyncio.gather(pending_upsert, return_exceptions=True)
         
-        logger.info(f"Successfully ingested {len(request.documents)} documents with {len(all_chunks)} chunks")
+        logger.info(f"Successfully ingested {len(request.documents)} documents with {upserted} chunks")
         
         return IngestionResponse(
             botId=request.botId,
-            upsertedEmbeddings=len(all_chunks),
+            upsertedEmbeddings=upserted,
             documents=len(request.documents)
         )
         
@@ -184,11 +436,44 @@ async def ingest_documents(request: IngestionRequest):
         logger.error(f"Ingestion failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ingestion failed: {str(e)}")
 
+@app.on_event("startup")
+async def startup():
+    global async_http_client
+    async_http_client = httpx.AsyncClient(
+        base_url=OLLAMA_BASE_URL,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=32)
+    )
+    embedding_batcher.start()
+    if EMBEDDING_PROVIDER == ModelProvider.OLLAMA:
+        app.state.ollama_warmup = asyncio.create_task(warm_up_ollama())
+
+async def warm_up_ollama(model: str = "nomic-embed-text"):
+    """Load the embedding model into Ollama so the first ingestion doesn't pay for it."""
+    try:
+        response = await async_http_client.post("/api/embed", json={"model": model, "input": ["warmup"]})
+        logger.info(f"Ollama embedding model warmup finished with status {response.status_code}")
+    except Exception as e:
+        logger.warning(f"Ollama embedding model warmup failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    ollama_warmup = getattr(app.state, "ollama_warmup", None)
+    if ollama_warmup is not None:
+        ollama_warmup.cancel()
+        await asyncio.gather(ollama_warmup, return_exceptions=True)
+    await embedding_batcher.stop()
+    await async_http_client.aclose()
+    if async_openai_client is not None:
+        await async_openai_client.close()
+    with embedding_cache_lock:
+        embedding_cache.close()
+
 @app.get("/health")
 async def health_check():
     ollama_status = "unknown"
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = await async_http_client.get("/api/tags", timeout=5)
         ollama_status = "healthy" if response.status_code == 200 else "unhealthy"
     except:
         ollama_status = "unreachable"
@@ -204,9 +489,9 @@ async def health_check():
 async def get_ollama_models():
     """Endpoint to check available Ollama models."""
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = await async_http_client.get("/api/tags", timeout=5)
         if response.status_code == 200:
-            return response.json()
+            return orjson.loads(response.content)
         else:
             return {"error": "Failed to fetch models"}
     except Exception as e:
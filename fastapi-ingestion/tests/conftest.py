@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Import app.main against a throwaway Chroma directory, even where CHROMA_PERSIST_DIR is already set
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["CHROMA_PERSIST_DIR"] = tempfile.mkdtemp(prefix="ingestion-tests-")
+os.environ["MODEL_PROVIDER"] = "mock"
+
+
+@pytest.fixture(autouse=True)
+def embedding_cache(monkeypatch):
+    """Give every test its own empty in-memory embedding cache."""
+    from app import main
+
+    connection = main.open_embedding_cache(":memory:")
+    monkeypatch.setattr(main, "embedding_cache", connection)
+    yield connection
+    connection.close()
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from app import main
+
+
+def run_with_batcher(monkeypatch, fake_aget_embeddings, scenario, max_batch_size=4, wait_timeout_s=0.001):
+    monkeypatch.setattr(main, "aget_embeddings", fake_aget_embeddings)
+
+    async def run():
+        batcher = main.EmbeddingBatcher(max_batch_size, wait_timeout_s, 2)
+        batcher.start()
+        try:
+            return await scenario(batcher)
+        finally:
+            await batcher.stop()
+
+    return asyncio.run(run())
+
+
+def test_batcher_returns_results_to_the_right_callers(monkeypatch):
+    calls = []
+
+    async def fake_aget_embeddings(texts):
+        calls.append(list(texts))
+        await asyncio.sleep(0)
+        return [[float(len(text))] for text in texts]
+
+    requests = [["a" * n for n in range(1, 6)], ["b" * n for n in range(10, 13)], ["c" * 20]]
+
+    async def scenario(batcher):
+        return await asyncio.gather(*(batcher.embed(texts) for texts in requests))
+
+    results = run_with_batcher(monkeypatch, fake_aget_embeddings, scenario)
+
+    for texts, result in zip(requests, results):
+        assert result == [[float(len(text))] for text in texts]
+    assert all(len(batch) <= 4 for batch in calls)
+    # Requests were coalesced: fewer provider calls than texts, and every text embedded once
+    assert sorted(text for batch in calls for text in batch) == sorted(text for texts in requests for text in texts)
+    assert len(calls) < sum(len(texts) for texts in requests)
+
+
+def test_batcher_propagates_provider_failure_to_every_caller(monkeypatch):
+    async def failing_aget_embeddings(texts):
+        raise RuntimeError("provider down")
+
+    async def scenario(batcher):
+        return await asyncio.gather(
+            batcher.embed(["a", "b", "c"]),
+            batcher.embed(["d", "e", "f", "g"]),
+            return_exceptions=True
+        )
+
+    results = run_with_batcher(monkeypatch, failing_aget_embeddings, scenario)
+
+    assert len(results) == 2
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_batcher_stop_waits_for_in_flight_batches(monkeypatch):
+    finished = []
+
+    async def slow_aget_embeddings(texts):
+        await asyncio.sleep(0.01)
+        finished.extend(texts)
+        return [[1.0] for _ in texts]
+
+    async def scenario(batcher):
+        task = asyncio.ensure_future(batcher.embed(["a", "b"]))
+        await asyncio.sleep(0.005)
+        await batcher.stop()
+        assert batcher.worker is None
+        return await task
+
+    results = run_with_batcher(monkeypatch, slow_aget_embeddings, scenario)
+
+    assert results == [[1.0], [1.0]]
+    assert finished == ["a", "b"]
+
+
+def test_batcher_stop_during_wait_window_fails_waiting_callers(monkeypatch):
+    calls = []
+
+    async def fake_aget_embeddings(texts):
+        calls.append(list(texts))
+        return [[1.0] for _ in texts]
+
+    async def scenario(batcher):
+        # The worker holds "a" in its 50 ms wait window; "b".."e" are still queued
+        first = asyncio.ensure_future(batcher.embed(["a"]))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(batcher.embed(["b", "c", "d", "e"]))
+        await asyncio.sleep(0.01)
+        await batcher.stop()
+        return await asyncio.wait_for(
+            asyncio.gather(first, second, return_exceptions=True),
+            timeout=1
+        )
+
+    results = run_with_batcher(monkeypatch, fake_aget_embeddings, scenario, wait_timeout_s=0.05)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert calls == []
+
+
+def test_batcher_fails_callers_when_provider_returns_too_few_vectors(monkeypatch):
+    async def short_aget_embeddings(texts):
+        return [[1.0] for _ in texts[1:]]
+
+    async def scenario(batcher):
+        return await asyncio.wait_for(batcher.embed(["a", "b", "c"]), timeout=1)
+
+    with pytest.raises(ValueError):
+        run_with_batcher(monkeypatch, short_aget_embeddings, scenario)
@@ -0,0 +1,36 @@
+import pytest
+from pydantic import ValidationError
+
+from app import main
+
+
+def chunk_text_reference(text, chunk_size, overlap):
+    """The original while-loop chunker that chunk_text must stay equivalent to."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunks.append(text[start:end])
+        start += chunk_size - overlap
+        if end >= len(text):
+            break
+    return chunks
+
+
+def test_chunk_text_matches_reference_loop():
+    for length in range(60):
+        text = "".join(chr(97 + i % 26) for i in range(length))
+        for chunk_size in range(1, 15):
+            for overlap in range(chunk_size):
+                assert main.chunk_text(text, chunk_size, overlap) == chunk_text_reference(text, chunk_size, overlap)
+
+
+@pytest.mark.parametrize("chunk_size, overlap", [(0, 0), (-5, 0), (100, -1), (100, 100), (100, 150)])
+def test_ingestion_request_rejects_chunking_that_cannot_advance(chunk_size, overlap):
+    with pytest.raises(ValidationError):
+        main.IngestionRequest(botId="bot-1", documents=[], chunkSize=chunk_size, overlap=overlap)
+
+
+def test_ingestion_request_defaults():
+    request = main.IngestionRequest(botId="bot-1", documents=[])
+    assert (request.chunkSize, request.overlap) == (600, 80)
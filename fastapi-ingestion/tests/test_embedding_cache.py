@@ -0,0 +1,52 @@
+import asyncio
+
+from app import main
+
+
+class FakeBatcher:
+    def __init__(self, embed_fn):
+        self.embed_fn = embed_fn
+        self.calls = []
+
+    async def embed(self, texts):
+        self.calls.append(list(texts))
+        return [self.embed_fn(text) for text in texts]
+
+
+def use_ollama_with(monkeypatch, embed_fn):
+    monkeypatch.setattr(main, "EMBEDDING_PROVIDER", main.ModelProvider.OLLAMA.value)
+    batcher = FakeBatcher(embed_fn)
+    monkeypatch.setattr(main, "embedding_batcher", batcher)
+    return batcher
+
+
+def test_cached_embeddings_skip_provider_for_repeated_chunks(monkeypatch):
+    batcher = use_ollama_with(monkeypatch, lambda text: [float(len(text)), 1.0])
+    texts = ["cached chunk one", "cached chunk two"]
+
+    first = asyncio.run(main.aget_cached_embeddings(texts))
+    second = asyncio.run(main.aget_cached_embeddings(texts))
+
+    # The second call is served entirely from the cache
+    assert batcher.calls == [texts]
+    assert first == second
+
+
+def test_cached_embeddings_do_not_cache_provider_failures(monkeypatch):
+    batcher = use_ollama_with(monkeypatch, lambda text: None)
+
+    first = asyncio.run(main.aget_cached_embeddings(["uncacheable chunk"]))
+    asyncio.run(main.aget_cached_embeddings(["uncacheable chunk"]))
+
+    assert first == [main.create_simple_embedding("uncacheable chunk")]
+    assert len(batcher.calls) == 2
+
+
+def test_cached_embeddings_embed_duplicate_chunks_once(monkeypatch):
+    batcher = use_ollama_with(monkeypatch, lambda text: [float(len(text)), 1.0])
+
+    embeddings = asyncio.run(main.aget_cached_embeddings(["footer", "body text", "footer"]))
+
+    assert batcher.calls == [["footer", "body text"]]
+    assert embeddings[0] == embeddings[2]
+    assert embeddings[0] != embeddings[1]
@@ -0,0 +1,72 @@
+import asyncio
+import hashlib
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from app import main
+
+
+class SlowCollection:
+    """Stands in for a Chroma collection whose upserts take a while to land."""
+
+    def __init__(self):
+        self.upserted_ids = []
+
+    def upsert(self, embeddings, documents, metadatas, ids):
+        time.sleep(0.05)
+        self.upserted_ids.append(list(ids))
+
+
+class FakeChromaClient:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get_collection(self, name):
+        return self.collection
+
+
+def ingest(monkeypatch, collection, fake_aget_cached_embeddings):
+    monkeypatch.setattr(main, "chroma_client", FakeChromaClient(collection))
+    monkeypatch.setattr(main, "aget_cached_embeddings", fake_aget_cached_embeddings)
+    monkeypatch.setattr(main, "UPSERT_BATCH_SIZE", 2)
+    # Four 10-character chunks, streamed as two upsert batches
+    request = main.IngestionRequest(
+        botId="bot-1",
+        documents=[main.DocumentInput(filename="doc.md", text="x" * 40)],
+        chunkSize=10,
+        overlap=0
+    )
+    return asyncio.run(main.ingest_documents(request))
+
+
+def test_ingest_streams_every_batch_to_chroma(monkeypatch):
+    async def fake_aget_cached_embeddings(chunks):
+        return [[1.0, 0.0] for _ in chunks]
+
+    collection = SlowCollection()
+    response = ingest(monkeypatch, collection, fake_aget_cached_embeddings)
+
+    assert response.upsertedEmbeddings == 4
+    assert [len(ids) for ids in collection.upserted_ids] == [2, 2]
+
+
+def test_ingest_waits_for_pending_upsert_when_embedding_fails(monkeypatch):
+    calls = []
+
+    async def failing_second_batch(chunks):
+        calls.append(chunks)
+        if len(calls) == 2:
+            raise RuntimeError("provider down")
+        return [[1.0, 0.0] for _ in chunks]
+
+    collection = SlowCollection()
+    with pytest.raises(HTTPException) as excinfo:
+        ingest(monkeypatch, collection, failing_second_batch)
+
+    assert excinfo.value.status_code == 500
+    # The first batch's upsert was still running when the second embedding failed;
+    # the handler must not return until that write has finished
+    first_batch_ids = [hashlib.md5(b"doc.md_%d_bot-1" % i).hexdigest() for i in range(2)]
+    assert collection.upserted_ids == [first_batch_ids]
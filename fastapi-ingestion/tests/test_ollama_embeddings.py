@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import httpx
+
+from app import main
+
+
+def embed_with_ollama(monkeypatch, handler, texts, batch_size=2):
+    monkeypatch.setattr(main, "EMBED_BATCH_SIZE", batch_size)
+
+    async def run():
+        async with httpx.AsyncClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler)) as client:
+            monkeypatch.setattr(main, "async_http_client", client)
+            return await main.aget_ollama_embeddings(texts)
+
+    return asyncio.run(run())
+
+
+def embed_response(texts):
+    return httpx.Response(200, json={"embeddings": [[float(len(text))] for text in texts]})
+
+
+def test_ollama_embeddings_are_requested_in_batches(monkeypatch):
+    requests = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        requests.append((request.url.path, body["model"], body["input"]))
+        return embed_response(body["input"])
+
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+    embeddings = embed_with_ollama(monkeypatch, handler, texts)
+
+    assert embeddings == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert sorted(requests) == [
+        ("/api/embed", "nomic-embed-text", ["a", "bb"]),
+        ("/api/embed", "nomic-embed-text", ["ccc", "dddd"]),
+        ("/api/embed", "nomic-embed-text", ["eeeee"]),
+    ]
+
+
+def test_failed_ollama_batch_returns_none_for_its_texts_only(monkeypatch):
+    def handler(request):
+        batch = json.loads(request.content)["input"]
+        if "bad" in batch:
+            return httpx.Response(500, text="model not found")
+        return embed_response(batch)
+
+    embeddings = embed_with_ollama(monkeypatch, handler, ["ok", "fine", "bad", "x"])
+
+    assert embeddings == [[2.0], [4.0], None, None]
+
+
+def test_ollama_batch_with_wrong_embedding_count_returns_none(monkeypatch):
+    def handler(request):
+        batch = json.loads(request.content)["input"]
+        if "short" in batch:
+            return embed_response(batch[1:])
+        return embed_response(batch)
+
+    embeddings = embed_with_ollama(monkeypatch, handler, ["short", "y", "zz"])
+
+    assert embeddings == [None, None, [2.0]]